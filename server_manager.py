@@ -2,10 +2,15 @@
 # server_manager.py
 
 import argparse
+import functools
 import subprocess
 import platform
 import os
+import re
+import select
+import shutil
 import sys
+import tempfile
 import time
 import signal
 
@@ -15,216 +20,292 @@ PHP_SERVER_PID_FILE = ".php_server.pid"
 DEFAULT_PORT = 80
 DOC_ROOT = "." # Assuming activator.php is in the same directory as this script
 
+# Platform details never change at runtime, so resolve them once at import
+# instead of shelling out via platform.system() on every hosts operation.
+_SYSTEM = platform.system().lower()
+
+def _compute_hosts_path():
+    """Resolves the OS-specific path to the hosts file (once, at import)."""
+    if _SYSTEM == "windows":
+        return os.path.join(os.environ.get("SystemRoot", "C:\\Windows"), "System32\\drivers\\etc\\hosts")
+    elif _SYSTEM in ["linux", "darwin"]: # darwin is macOS
+        return "/etc/hosts"
+    else:
+        print(f"Unsupported OS: {platform.system()}")
+        return None
+
+_HOSTS_PATH = _compute_hosts_path()
+
+# Whether we're running with admin/root privileges; checked once here rather
+# than re-probing (and re-importing ctypes) on every server start.
+if sys.platform == "win32":
+    try:
+        import ctypes
+        _IS_ADMIN = ctypes.windll.shell32.IsUserAnAdmin() != 0
+    except Exception:
+        _IS_ADMIN = False
+        print("⚠️ Could not determine admin status on Windows via ctypes.")
+else:
+    _IS_ADMIN = (os.geteuid() == 0) if hasattr(os, "geteuid") else False
+
 # --- Helper Functions ---
 
+# Resolved path to the PHP binary, filled in by check_php_installed() so
+# start_php_server() doesn't have to walk PATH again.
+_PHP_BIN = None
+
 def check_php_installed():
     """Checks if PHP CLI is installed and accessible."""
-    try:
-        subprocess.run(["php", "--version"], capture_output=True, check=True, text=True)
+    # A PATH lookup is all we need here; actually spawning `php --version`
+    # would cost tens of milliseconds of interpreter startup for no gain.
+    global _PHP_BIN
+    _PHP_BIN = shutil.which("php")
+    if _PHP_BIN:
         print("✅ PHP is installed.")
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        print("❌ PHP is not installed or not in PATH. Please install PHP and ensure it's in your system PATH.")
-        return False
+    print("❌ PHP is not installed or not in PATH. Please install PHP and ensure it's in your system PATH.")
+    return False
 
 def get_hosts_file_path():
     """Returns the OS-specific path to the hosts file."""
-    system = platform.system().lower()
-    if system == "windows":
-        return os.path.join(os.environ.get("SystemRoot", "C:\\Windows"), "System32\\drivers\\etc\\hosts")
-    elif system in ["linux", "darwin"]: # darwin is macOS
-        return "/etc/hosts"
-    else:
-        print(f"Unsupported OS: {platform.system()}")
-        return None
+    return _HOSTS_PATH
+
+# The hosts file is checked several times per start/stop (interactive prompt,
+# add, remove, post-failure cleanup). Cache its contents keyed by mtime so we
+# only re-read it when it actually changed on disk.
+_hosts_cache = {"mtime": None, "data": b""}
+
+@functools.lru_cache(maxsize=None)
+def _compile_entry_pattern(entry):
+    """Compiles (and memoizes) a pattern matching an uncommented hosts line
+    containing entry, so the whole file is scanned in one C-level pass."""
+    # The comment lookahead must cover the leading whitespace too: with
+    # `^[ \t]*(?!#)` the greedy run backtracks past the lookahead and an
+    # indented commented-out line would still match.
+    return re.compile(rb"(?m)^(?![ \t]*#)[^\n]*" + re.escape(entry.encode()))
+
+def _read_hosts(hosts_path):
+    """Returns the hosts file contents as bytes, re-reading from disk only
+    when the file's mtime has changed since the last read."""
+    mtime = os.stat(hosts_path).st_mtime_ns
+    if _hosts_cache["mtime"] != mtime:
+        with open(hosts_path, "rb") as f:
+            _hosts_cache["data"] = f.read()
+        _hosts_cache["mtime"] = mtime
+    return _hosts_cache["data"]
+
+def _invalidate_hosts_cache():
+    """Forces the next is_entry_in_hosts() call to re-read the hosts file."""
+    _hosts_cache["mtime"] = None
+
+# Per-OS DNS cache flush commands, looked up once instead of re-branching on
+# the platform at every call site. resolvectl is a no-op unless
+# systemd-resolved is in use, which is fine.
+_DNS_FLUSH_CMD = {
+    "windows": ["ipconfig", "/flushdns"],
+    "darwin": ["dscacheutil", "-flushcache"],
+    "linux": ["resolvectl", "flush-caches"],
+}
+
+# DNS-flush subprocesses launched fire-and-forget; reaped at shutdown so they
+# don't linger as zombies.
+_flush_procs = []
+
+def _flush_dns():
+    """Kicks off a background DNS cache flush appropriate for this OS."""
+    command = _DNS_FLUSH_CMD.get(_SYSTEM)
+    if not command:
+        return
+    print(f"ℹ️  Flushing DNS cache in the background ({' '.join(command)})...")
+    try:
+        _flush_procs.append(subprocess.Popen(command,
+                                             stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL))
+    except Exception as e:
+        print(f"⚠️ Could not flush DNS cache automatically: {e}. A reboot or manual flush might be needed.")
+
+def _reap_dns_flushes():
+    """Waits for any background DNS-flush subprocesses to finish."""
+    while _flush_procs:
+        _flush_procs.pop().wait()
 
 def is_entry_in_hosts(entry_to_check=HOSTS_ENTRY):
     """Checks if the specified entry is in the hosts file."""
-    hosts_path = get_hosts_file_path()
+    hosts_path = _HOSTS_PATH
     if not hosts_path:
         return False
     try:
-        with open(hosts_path, "r") as f:
-            for line in f:
-                if entry_to_check in line and not line.strip().startswith("#"):
-                    return True
+        data = _read_hosts(hosts_path)
     except FileNotFoundError:
         print(f"🔍 Hosts file not found at {hosts_path} (This is unexpected).")
         return False
     except Exception as e:
         print(f"⚠️ Error reading hosts file: {e}")
         return False # Assume not present if error
-    return False
+    return _compile_entry_pattern(entry_to_check).search(data) is not None
 
-def _run_privileged_command(command_list):
-    """
-    Attempts to run a command that typically requires elevated privileges.
-    For Linux/macOS, prepends 'sudo'. For Windows, it just runs it and
-    relies on the script itself being run as Administrator.
-    Returns True on success (exit code 0), False otherwise.
-    """
-    system = platform.system().lower()
-    if system in ["linux", "darwin"]:
-        full_command = ["sudo"] + command_list
-    elif system == "windows":
-        full_command = command_list # Assumes script is run as Admin
-    else:
-        print(f"Unsupported OS for privileged command: {platform.system()}")
-        return False
-
-    try:
-        print(f"ℹ️  Attempting to run: {' '.join(full_command)}")
-        print( "    This may ask for your administrator/sudo password to modify the hosts file.")
-        # Using shell=True for Windows to correctly interpret built-in commands if needed,
-        # and to handle sudo correctly on Unix-like systems.
-        # For simple commands like 'echo >> hosts', it's often easier.
-        # However, direct file I/O is safer for hosts file modification.
-        # This function is a placeholder for a more robust solution if direct I/O fails.
-        # For now, we will use direct file I/O in add/remove functions.
-        # This function can be used for other privileged tasks if needed.
-        # For hosts, we'll use direct write with a sudo wrapper for the python script itself.
-        # This function is therefore simplified for now or might be removed if not used.
-
-        # Re-evaluating: direct file I/O is better. This function might not be needed
-        # if we guide user to run the whole script with sudo/admin.
-        # Let's assume the whole script is run with necessary privileges for now.
-        # subprocess.run(full_command, check=True)
-        # For modifying hosts file, it's better to read content, modify, and write back.
-        # This function will be simplified as direct write is preferred.
-        pass # Placeholder, direct I/O to be implemented in add/remove
-        return True # Assume success for now
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error executing privileged command: {e}")
-        return False
-    except FileNotFoundError:
-        if system in ["linux", "darwin"] and command_list[0] != "sudo": # if sudo itself is not found
-             print("❌ sudo command not found. Please ensure it's installed and in PATH for Linux/macOS.")
-        else:
-            print(f"❌ Command not found: {command_list[0]}")
-        return False
+# Tri-state results for the hosts mutators, so callers can tell an actual
+# change apart from an idempotent re-run (which needs no DNS flush).
+HOSTS_CHANGED = "changed"
+HOSTS_NOOP = "noop"
+HOSTS_FAILED = "failed"
 
+def add_to_hosts(entry_to_add=HOSTS_ENTRY, known_absent=False):
+    """Adds the entry to the hosts file. Assumes script is run with sufficient privileges.
 
-def add_to_hosts(entry_to_add=HOSTS_ENTRY):
-    """Adds the entry to the hosts file. Assumes script is run with sufficient privileges."""
-    hosts_path = get_hosts_file_path()
+    Pass known_absent=True when the caller has already confirmed the entry is
+    missing, to skip the redundant re-check. Returns HOSTS_CHANGED,
+    HOSTS_NOOP or HOSTS_FAILED."""
+    hosts_path = _HOSTS_PATH
     if not hosts_path:
-        return False
-    if is_entry_in_hosts(entry_to_add):
+        return HOSTS_FAILED
+    if not known_absent and is_entry_in_hosts(entry_to_add):
         print(f"✅ Hosts entry '{entry_to_add}' already exists.")
-        return True
+        return HOSTS_NOOP
     try:
         with open(hosts_path, "a") as f:
             f.write(f"\n{entry_to_add}\n")
+        _invalidate_hosts_cache()
         print(f"✅ Added '{entry_to_add}' to hosts file ({hosts_path}).")
-        if platform.system().lower() in ["linux", "darwin"]:
-            print("ℹ️  Note: DNS cache flush might be needed on some systems (e.g., `sudo dscacheutil -flushcache` on macOS or restart nscd/systemd-resolved on Linux).")
-        elif platform.system().lower() == "windows":
-            print("ℹ️  Attempting to flush DNS cache on Windows...")
-            try:
-                subprocess.run(["ipconfig", "/flushdns"], capture_output=True, check=True)
-                print("✅ Windows DNS cache flushed.")
-            except Exception as e:
-                print(f"⚠️ Could not flush Windows DNS cache automatically: {e}. A reboot or manual flush might be needed.")
-        return True
+        _flush_dns()
+        return HOSTS_CHANGED
     except Exception as e:
         print(f"❌ Failed to add entry to hosts file: {e}")
         print(f"   Ensure you are running this script with administrator/sudo privileges.")
-        return False
+        return HOSTS_FAILED
 
 def remove_from_hosts(entry_to_remove=HOSTS_ENTRY):
-    """Removes the entry from the hosts file. Assumes script is run with sufficient privileges."""
-    hosts_path = get_hosts_file_path()
+    """Removes the entry from the hosts file. Assumes script is run with sufficient privileges.
+
+    Returns HOSTS_CHANGED, HOSTS_NOOP or HOSTS_FAILED."""
+    hosts_path = _HOSTS_PATH
     if not hosts_path:
-        return False
-    if not is_entry_in_hosts(entry_to_remove):
-        print(f"✅ Hosts entry '{entry_to_remove}' not found, no removal needed.")
-        return True
+        return HOSTS_FAILED
     try:
+        # Single read: presence is detected while filtering, so no separate
+        # is_entry_in_hosts() scan (and no extra file open) is needed first.
         with open(hosts_path, "r") as f:
             lines = f.readlines()
-        with open(hosts_path, "w") as f:
-            entry_found_and_removed = False
-            for line in lines:
-                if entry_to_remove in line and not line.strip().startswith("#"):
-                    entry_found_and_removed = True
-                    # Skip writing this line to remove it
-                else:
-                    f.write(line)
-        if entry_found_and_removed:
-            print(f"✅ Removed '{entry_to_remove}' from hosts file ({hosts_path}).")
-        else:
-            # This case should be caught by is_entry_in_hosts, but as a safeguard:
-            print(f"ℹ️  Entry '{entry_to_remove}' was not actively present to remove (e.g. commented out or formatting mismatch).")
-
-        if platform.system().lower() in ["linux", "darwin"]:
-             print("ℹ️  Note: DNS cache flush might be needed on some systems.")
-        elif platform.system().lower() == "windows":
-            print("ℹ️  Attempting to flush DNS cache on Windows...")
-            try:
-                subprocess.run(["ipconfig", "/flushdns"], capture_output=True, check=True)
-                print("✅ Windows DNS cache flushed.")
-            except Exception as e:
-                print(f"⚠️ Could not flush Windows DNS cache automatically: {e}. A reboot or manual flush might be needed.")
-        return True
+        kept_lines = [line for line in lines
+                      if entry_to_remove not in line or line.strip().startswith("#")]
+        if len(kept_lines) == len(lines):
+            print(f"✅ Hosts entry '{entry_to_remove}' not found, no removal needed.")
+            return HOSTS_NOOP
+        # Write the filtered content to a temp file in the same directory and
+        # atomically rename it over the hosts file. Truncating in place would
+        # leave an empty/partial hosts file if we crashed mid-write.
+        st = os.stat(hosts_path)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(hosts_path),
+                                         prefix="hosts.", delete=False) as tmp:
+            tmp.write("".join(kept_lines))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            os.chmod(tmp.name, st.st_mode & 0o7777)
+        os.replace(tmp.name, hosts_path)
+        _invalidate_hosts_cache()
+        print(f"✅ Removed '{entry_to_remove}' from hosts file ({hosts_path}).")
+        _flush_dns()
+        return HOSTS_CHANGED
     except Exception as e:
         print(f"❌ Failed to remove entry from hosts file: {e}")
         print(f"   Ensure you are running this script with administrator/sudo privileges.")
-        return False
+        return HOSTS_FAILED
 
 
 # --- Main Server Logic ---
 
+# Descriptor of the held start lock; kept open (and locked) for the lifetime
+# of the server so a concurrent `start` fails fast instead of clobbering the
+# PID file.
+_server_lock_fd = None
+
+def _acquire_server_lock():
+    """Takes an exclusive advisory lock guarding against concurrent starts.
+
+    Returns True if acquired, False if another instance already holds it.
+    Idempotent: returns True immediately if this process already holds it."""
+    global _server_lock_fd
+    if _server_lock_fd is not None:
+        return True
+    fd = os.open(PHP_SERVER_PID_FILE + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _server_lock_fd = fd
+    return True
+
+def _release_server_lock():
+    """Releases the start lock (closing the descriptor drops the lock)."""
+    global _server_lock_fd
+    if _server_lock_fd is not None:
+        os.close(_server_lock_fd)
+        _server_lock_fd = None
+
 def start_php_server(port=DEFAULT_PORT, doc_root=DOC_ROOT):
     """Starts the PHP built-in web server as a subprocess."""
-    if not os.path.exists("activator.php"):
-        print(f"❌ activator.php not found in the current directory ({os.getcwd()}).")
+    # Resolve the document root once and stat activator.php directly: one
+    # syscall instead of exists()+getcwd()+abspath(), and no TOCTOU gap
+    # between an exists() probe and PHP's own open.
+    doc_root_abs = os.path.abspath(doc_root)
+    try:
+        os.stat(os.path.join(doc_root_abs, "activator.php"))
+    except FileNotFoundError:
+        print(f"❌ activator.php not found in the document root ({doc_root_abs}).")
         print(f"   Please ensure activator.php is in the same directory as this script, or specify the correct document root.")
         return None
 
     # Check if port is privileged
     is_privileged_port = (port < 1024)
-    needs_admin_privileges = False
-    current_user_has_admin = False
-
-    system = platform.system().lower()
-    if system in ["linux", "darwin"]:
-        # On Unix, os.geteuid() == 0 means root
-        current_user_has_admin = (os.geteuid() == 0)
-    elif system == "windows":
-        try:
-            # On Windows, check if the user is an administrator.
-            import ctypes
-            current_user_has_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
-        except Exception:
-            # If ctypes fails (e.g. not available, though standard), assume not admin.
-            current_user_has_admin = False
-            print("⚠️ Could not determine admin status on Windows via ctypes.")
-
 
-    if is_privileged_port and not current_user_has_admin:
+    if is_privileged_port and not _IS_ADMIN:
         print(f"⚠️ Warning: Port {port} is a privileged port.")
-        if system == "windows":
+        if _SYSTEM == "windows":
             print(f"   You might need to run this script as an Administrator to use port {port}.")
         else: # Linux/macOS
             print(f"   You might need to use 'sudo python3 server_manager.py start --port {port}' or run as root.")
         # We can still attempt to start, PHP might fail with a permission error
 
-    php_command = ["php", f"-S", f"0.0.0.0:{port}", "-t", doc_root]
+    php_command = [_PHP_BIN or "php", f"-S", f"0.0.0.0:{port}", "-t", doc_root_abs]
     print(f"🚀 Starting PHP server: {' '.join(php_command)}")
-    print(f"   Serving from: {os.path.abspath(doc_root)}")
+    print(f"   Serving from: {doc_root_abs}")
     print(f"   PHP server output will be shown below. Press Ctrl+C here to try to stop it.")
 
+    if not _acquire_server_lock():
+        print(f"❌ Another instance of this script appears to be running the server (lock on {PHP_SERVER_PID_FILE}.lock is held).")
+        print(f"   Stop it first, or remove the lock file if it is stale.")
+        return None
+
     try:
         # Start the server in a way that it can be managed (e.g., not blocking the Python script entirely if possible,
         # or by detaching and storing PID)
         # For simplicity with PHP's built-in server, it's often run and monitored directly.
         # Popen allows us to manage it as a subprocess.
-        process = subprocess.Popen(php_command, stdout=sys.stdout, stderr=sys.stderr)
-
-        # Save PID to stop it later
+        # Hand PHP the raw stdout/stderr fds so its log lines bypass Python's
+        # stream wrappers (and it can detect a TTY for colored output).
         try:
-            with open(PHP_SERVER_PID_FILE, "w") as f:
+            stdout_fd = sys.stdout.fileno()
+            stderr_fd = sys.stderr.fileno()
+        except (AttributeError, OSError, ValueError):
+            # Streams without a real fd (e.g. replaced by a test harness).
+            stdout_fd, stderr_fd = sys.stdout, sys.stderr
+        process = subprocess.Popen(php_command, stdout=stdout_fd, stderr=stderr_fd, close_fds=True)
+
+        # Save PID to stop it later; write-then-rename so a crash mid-write
+        # can't leave a truncated PID behind.
+        try:
+            tmp_pid_path = PHP_SERVER_PID_FILE + ".tmp"
+            with open(tmp_pid_path, "w") as f:
                 f.write(str(process.pid))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_pid_path, PHP_SERVER_PID_FILE)
             print(f"✅ PHP server started with PID {process.pid} (PID saved to {PHP_SERVER_PID_FILE}).")
         except IOError as e:
             print(f"⚠️ Could not write PID file {PHP_SERVER_PID_FILE}: {e}")
@@ -234,9 +315,25 @@ def start_php_server(port=DEFAULT_PORT, doc_root=DOC_ROOT):
     except FileNotFoundError:
         print("❌ PHP command not found. Ensure PHP is installed and in your PATH.")
         # check_php_installed() would have caught this earlier, but as a safeguard.
+        _release_server_lock()
         return None
     except Exception as e:
         print(f"❌ Failed to start PHP server: {e}")
+        _release_server_lock()
+        return None
+
+def _proc_start_time(pid):
+    """Returns the kernel start time of pid from /proc, or None if unavailable.
+
+    Comparing start times lets us detect that a PID was recycled by an
+    unrelated process before we escalate to SIGKILL."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+        # comm (field 2) may contain spaces, so split after its closing paren;
+        # starttime is field 22, i.e. index 19 of the remainder.
+        return int(stat.rsplit(b")", 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
         return None
 
 def stop_php_server():
@@ -257,20 +354,52 @@ def stop_php_server():
 
     print(f"🛑 Stopping PHP server with PID {pid}...")
     try:
+        # On Linux 5.3+ we can open a pidfd before signalling and select() on
+        # it: it becomes readable the instant the process exits, so a clean
+        # stop takes milliseconds instead of the fixed 2-second sleep.
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(pid)
+            except OSError:
+                pidfd = None # Process may already be gone; os.kill below will tell us.
+        # Without a pidfd, snapshot the start time so the SIGKILL escalation
+        # can't hit an unrelated process that recycled the PID.
+        start_time = _proc_start_time(pid) if pidfd is None else None
+
         # Send SIGTERM first for graceful shutdown
         os.kill(pid, signal.SIGTERM)
-        print(f"   Sent SIGTERM to PID {pid}. Waiting a moment...")
-        time.sleep(2) # Give it a couple of seconds to shut down
+        print(f"   Sent SIGTERM to PID {pid}. Waiting for it to exit...")
 
-        # Check if process still exists
-        # os.kill(pid, 0) will raise an OSError if the process does not exist.
         try:
-            os.kill(pid, 0) # Check if process is still alive
-            print(f"   Server with PID {pid} did not terminate with SIGTERM. Sending SIGKILL...")
-            os.kill(pid, signal.SIGKILL) # Force kill
-            print(f"   Sent SIGKILL to PID {pid}.")
-        except OSError:
-            print(f"✅ Server with PID {pid} terminated successfully.")
+            terminated = False
+            if pidfd is not None:
+                terminated = bool(select.select([pidfd], [], [], 2)[0])
+            else:
+                # Fallback for platforms without pidfds: sleep then probe.
+                time.sleep(2) # Give it a couple of seconds to shut down
+                try:
+                    os.kill(pid, 0) # Raises OSError if the process no longer exists
+                except OSError:
+                    terminated = True
+                else:
+                    if start_time is not None and _proc_start_time(pid) != start_time:
+                        # The PID now belongs to a different process; ours is gone.
+                        terminated = True
+
+            if terminated:
+                print(f"✅ Server with PID {pid} terminated successfully.")
+            else:
+                print(f"   Server with PID {pid} did not terminate with SIGTERM. Sending SIGKILL...")
+                if pidfd is not None:
+                    # Signal through the pidfd so a recycled PID can't be hit.
+                    signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+                else:
+                    os.kill(pid, signal.SIGKILL) # Force kill
+                print(f"   Sent SIGKILL to PID {pid}.")
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
 
         success = True
     except ProcessLookupError: # PID not found
@@ -299,10 +428,12 @@ if __name__ == "__main__":
     start_parser = subparsers.add_parser("start", help="Start the PHP server and configure hosts file.")
     start_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port for the PHP server (default: {DEFAULT_PORT})")
     start_parser.add_argument("--no-hosts", action="store_true", help="Skip hosts file modification.")
+    start_parser.add_argument("-y", "--yes", action="store_true", help="Answer yes to all prompts (for scripted/non-interactive use).")
 
     # Stop command
     stop_parser = subparsers.add_parser("stop", help="Stop the PHP server and revert hosts file.")
     stop_parser.add_argument("--no-hosts", action="store_true", help="Skip hosts file modification (revert).")
+    stop_parser.add_argument("-y", "--yes", action="store_true", help="Answer yes to all prompts (for scripted/non-interactive use).")
 
     # Status command (optional, can be added later)
     # status_parser = subparsers.add_parser("status", help="Check server and hosts file status.")
@@ -312,15 +443,19 @@ if __name__ == "__main__":
     # --- Command Handling ---
     php_process = None # To hold the server process if started
 
-    def manage_hosts_add_interactive(skip_hosts_mod):
+    def manage_hosts_add_interactive(skip_hosts_mod, assume_yes=False):
         if skip_hosts_mod:
             print("ℹ️  Skipping hosts file modification as per --no-hosts.")
             return
         if not is_entry_in_hosts():
             print(f"❓ The hosts file entry '{HOSTS_ENTRY}' is not present.")
-            choice = input("   Do you want to add it now? This usually requires admin/sudo privileges. (y/n): ").lower()
+            if assume_yes:
+                choice = 'y'
+            else:
+                choice = input("   Do you want to add it now? This usually requires admin/sudo privileges. (y/n): ").lower()
             if choice == 'y':
-                if not add_to_hosts():
+                # We just confirmed the entry is absent, so skip the re-check.
+                if add_to_hosts(known_absent=True) == HOSTS_FAILED:
                     print("⚠️ Failed to add hosts entry. Manual addition might be required, or run script with sufficient privileges.")
                     sys.exit(1) # Exit if hosts modification was requested but failed.
             else:
@@ -328,15 +463,18 @@ if __name__ == "__main__":
         else:
             print(f"✅ Hosts entry '{HOSTS_ENTRY}' is already present.")
 
-    def manage_hosts_remove_interactive(skip_hosts_mod):
+    def manage_hosts_remove_interactive(skip_hosts_mod, assume_yes=False):
         if skip_hosts_mod:
             print("ℹ️  Skipping hosts file removal as per --no-hosts.")
             return
         if is_entry_in_hosts(): # Check again in case it was removed manually
             print(f"❓ The hosts file entry '{HOSTS_ENTRY}' is present.")
-            choice = input("   Do you want to remove it now? This usually requires admin/sudo privileges. (y/n): ").lower()
+            if assume_yes:
+                choice = 'y'
+            else:
+                choice = input("   Do you want to remove it now? This usually requires admin/sudo privileges. (y/n): ").lower()
             if choice == 'y':
-                if not remove_from_hosts():
+                if remove_from_hosts() == HOSTS_FAILED:
                     print("⚠️ Failed to remove hosts entry. Manual removal might be required, or run script with sufficient privileges.")
             else:
                 print("ℹ️  Skipping hosts file removal. Remember to remove it manually later if needed.")
@@ -349,7 +487,16 @@ if __name__ == "__main__":
         if not check_php_installed():
             sys.exit(1)
 
-        manage_hosts_add_interactive(args.no_hosts)
+        # Take the start lock before touching the hosts file: a concurrent
+        # start must fail here, not after adding the entry, or its failure
+        # cleanup would revert the hosts entry out from under the already
+        # running instance.
+        if not _acquire_server_lock():
+            print(f"❌ Another instance of this script appears to be running the server (lock on {PHP_SERVER_PID_FILE}.lock is held).")
+            print(f"   Stop it first, or remove the lock file if it is stale.")
+            sys.exit(1)
+
+        manage_hosts_add_interactive(args.no_hosts, args.yes)
 
         php_process = start_php_server(args.port, DOC_ROOT)
 
@@ -359,10 +506,10 @@ if __name__ == "__main__":
             print( "   For full iTunes compatibility, ensure your system trusts a self-signed SSL cert for albert.apple.com on this port if iTunes uses HTTPS.")
             print( "   Press Ctrl+C in this window to stop the server.")
             try:
-                # Keep the script alive while the PHP server runs,
-                # and listen for Ctrl+C to stop it.
-                while php_process.poll() is None: # While process is running
-                    time.sleep(0.5)
+                # Block until the PHP server exits; wait() parks us in the
+                # kernel instead of waking up to poll, and Ctrl+C still
+                # interrupts it cleanly.
+                php_process.wait()
                 print("ℹ️  PHP server process seems to have terminated on its own.")
             except KeyboardInterrupt:
                 print("\n⌨️ Ctrl+C detected. Stopping server...")
@@ -370,7 +517,9 @@ if __name__ == "__main__":
                 # This block will run if loop finishes or on KeyboardInterrupt from within this script
                 if php_process and php_process.poll() is None: # If still running (e.g. Ctrl+C outside of Popen's direct handling)
                     stop_php_server() # Use our PID based stop
-                manage_hosts_remove_interactive(args.no_hosts) # Offer to remove hosts on exit
+                _release_server_lock()
+                manage_hosts_remove_interactive(args.no_hosts, args.yes) # Offer to remove hosts on exit
+                _reap_dns_flushes()
                 print("--- Server shutdown complete ---")
         else:
             print("❌ Server failed to start.")
@@ -386,7 +535,8 @@ if __name__ == "__main__":
             print("⚠️  Server may not have stopped cleanly. Check manually.")
         else:
             print("✅ Server stopped successfully or was not running.")
-        manage_hosts_remove_interactive(args.no_hosts)
+        manage_hosts_remove_interactive(args.no_hosts, args.yes)
+        _reap_dns_flushes()
         print("--- Server shutdown process complete ---")
 
     else: